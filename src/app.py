@@ -1,34 +1,50 @@
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, jsonify, request
 from .groq_api import get_artists_from_groq
 from .face_mood_analyzer import get_mood_from_webcam
-from .spotify_api import create_playlist_from_artists, create_playlist_for_one_artist
+from .spotify_api import create_playlist_from_artists, create_playlist_for_one_artist, ensure_authed
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__, template_folder='../templates')
 
+# Background work that doesn't depend on the mood, started while the webcam is capturing.
+executor = ThreadPoolExecutor(max_workers=4)
+
 @app.route('/')
 def home():
     return render_template('index.html')
 
 @app.route('/generate_playlist')
-def generate_playlist():
+async def generate_playlist():
     try:
         language = request.args.get('language', None)
         artist = request.args.get('artist', None) 
 
-        mood = get_mood_from_webcam()
+        # Spotify auth (token refresh + user lookup) doesn't need the mood, so it overlaps
+        # with the capture window instead of running after it.
+        spotify_future = asyncio.wrap_future(executor.submit(ensure_authed))
+
+        # The webcam capture, Groq and Spotify clients are blocking, so they run in worker
+        # threads. Groq goes through the sync client because its connection pool outlives
+        # the per-request event loop.
+        mood = await asyncio.to_thread(get_mood_from_webcam)
         if not mood:
             return jsonify({"success": False, "error": "Could not detect mood."})
         
         print(f"Mood detected: {mood}. Artist requested: {artist}")
 
+        sp, _ = await spotify_future
+        if not sp:
+            return jsonify({"success": False, "error": "Could not authenticate with Spotify."})
+
         if artist:
             print(f"User requested specific artist: {artist}.")
             playlist_name = f"{artist}'s Top Tracks"
-            playlist_url, final_songs = create_playlist_for_one_artist(artist, playlist_name)
+            playlist_url, final_songs = await asyncio.to_thread(create_playlist_for_one_artist, artist, playlist_name)
             
             if playlist_url:
                  return jsonify({
@@ -43,12 +59,13 @@ def generate_playlist():
         else:
             print("No specific artist requested. Getting artists from Groq.")
             
-            recommended_artists = get_artists_from_groq(mood, language)
+            recommended_artists = await asyncio.to_thread(get_artists_from_groq, mood, language)
             if not recommended_artists:
                 return jsonify({"success": False, "error": "No artists were received from the AI."})
 
             playlist_name = f"{mood.capitalize()} Mood Playlist"
-            playlist_url, final_songs = create_playlist_from_artists(
+            playlist_url, final_songs = await asyncio.to_thread(
+                create_playlist_from_artists,
                 artists=recommended_artists, 
                 mood=mood,
                 playlist_name=playlist_name
@@ -68,5 +85,15 @@ def generate_playlist():
         print(f"An unexpected error occurred in the main app: {e}")
         return jsonify({"success": False, "error": "A server error occurred. Check the terminal for details."})
 
+def serve(bind="127.0.0.1:5000"):
+    # Single-process entry point. To serve several clients at once, run more workers:
+    #   hypercorn src.app:app --workers 4 --worker-class asyncio
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [bind]
+    asyncio.run(hypercorn_serve(app, config))
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    serve()
\ No newline at end of file
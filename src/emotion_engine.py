@@ -0,0 +1,463 @@
+import os
+import tempfile
+import threading
+import cv2
+import numpy as np
+
+EMOTION_LABELS = ('angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral')
+FACE_SIZE = 48
+# Frames wider than this are downscaled before face detection; the crops still end up 48x48.
+DETECTION_WIDTH = 480
+
+MODEL_DIR = os.getenv("MOOD_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+ONNX_PATH = os.path.join(MODEL_DIR, "emotion.onnx")
+FUSED_ONNX_PATH = os.path.join(MODEL_DIR, "emotion_fused.onnx")
+INT8_ONNX_PATH = os.path.join(MODEL_DIR, "emotion_int8.onnx")
+# Images (webcam snapshots, photos) whose faces calibrate the INT8 model's activation ranges.
+CALIBRATION_DIR = os.getenv("MOOD_CALIBRATION_DIR", os.path.join(MODEL_DIR, "calibration"))
+CALIBRATION_FACES = 100
+
+# Limits baked into the fused engine's optimization profile.
+MAX_FACES_PER_FRAME = 4
+MAX_DETECTION_HEIGHT = 1080
+
+# CascadeClassifier keeps per-call scratch state, so every analysis thread gets its own.
+_local = threading.local()
+
+
+def _face_detector():
+    detector = getattr(_local, 'face_detector', None)
+    if detector is None:
+        detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        _local.face_detector = detector
+    return detector
+
+
+def _write_atomically(path, write):
+    # Several server workers may build the same model at once; writing to a temp file
+    # and renaming it means nobody ever loads a half-written file.
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def detect_faces(gray):
+    faces = _face_detector().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+    if len(faces) == 0:
+        return []
+    # Largest face first, so callers that only look at result [0] get the main subject.
+    return sorted((tuple(int(v) for v in f) for f in faces), key=lambda f: f[2] * f[3], reverse=True)
+
+
+def crop_faces(gray, boxes):
+    crops = np.empty((len(boxes), FACE_SIZE, FACE_SIZE, 1), dtype=np.float32)
+    for i, (x, y, w, h) in enumerate(boxes):
+        crops[i, :, :, 0] = cv2.resize(gray[y:y + h, x:x + w], (FACE_SIZE, FACE_SIZE), interpolation=cv2.INTER_AREA)
+    crops /= 255.0
+    return crops
+
+
+def to_detection_gray(frame):
+    """Grayscale `frame`, downscaled to DETECTION_WIDTH if wider; returns the image and the scale used."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    scale = 1.0
+    if w > DETECTION_WIDTH:
+        scale = DETECTION_WIDTH / w
+        gray = cv2.resize(gray, (DETECTION_WIDTH, int(h * scale)), interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def to_analysis(box, probs, scale=1.0):
+    x, y, w, h = (int(round(v / scale)) for v in box)
+    return {
+        'region': {'x': x, 'y': y, 'w': w, 'h': h},
+        'emotion': {label: float(p) * 100 for label, p in zip(EMOTION_LABELS, probs)},
+        'dominant_emotion': EMOTION_LABELS[int(np.argmax(probs))],
+    }
+
+
+def analyze_frames(engine, frames):
+    """Detect faces in every frame and classify all of them in one engine call.
+
+    Returns one list of DeepFace-style analysis dicts per frame, with regions in
+    the coordinates of the original frame.
+    """
+    fused = getattr(engine, 'fused', False)
+    boxes_per_frame = []
+    face_frames = []
+    crops = []
+    for frame in frames:
+        gray, scale = to_detection_gray(frame)
+        boxes = detect_faces(gray)
+        if fused:
+            boxes = boxes[:MAX_FACES_PER_FRAME]
+        boxes_per_frame.append((boxes, scale))
+        if boxes:
+            if fused:
+                face_frames.append(gray)
+            else:
+                crops.append(crop_faces(gray, boxes))
+
+    if not crops and not face_frames:
+        return [[] for _ in frames]
+
+    if fused:
+        # Cropping, resizing and normalization happen inside the engine.
+        face_boxes = [boxes for boxes, _ in boxes_per_frame if boxes]
+        rois = np.array([(x, y, x + w, y + h) for boxes in face_boxes for x, y, w, h in boxes], dtype=np.float32)
+        roi_batch = np.array([i for i, boxes in enumerate(face_boxes) for _ in boxes], dtype=np.int32)
+        probs = engine.infer(np.stack(face_frames)[:, None], rois, roi_batch)
+    else:
+        probs = engine.predict(np.concatenate(crops))
+
+    results = []
+    i = 0
+    for boxes, scale in boxes_per_frame:
+        results.append([to_analysis(box, probs[i + j], scale) for j, box in enumerate(boxes)])
+        i += len(boxes)
+    return results
+
+
+def load_keras_emotion_model():
+    from deepface import DeepFace
+    try:
+        client = DeepFace.build_model(model_name='Emotion', task='facial_attribute')
+    except TypeError:
+        client = DeepFace.build_model('Emotion')
+    # Newer DeepFace versions wrap the Keras model in a client object.
+    return getattr(client, 'model', client)
+
+
+def export_emotion_onnx(path=ONNX_PATH):
+    import tensorflow as tf
+    import tf2onnx
+
+    model = load_keras_emotion_model()
+    spec = (tf.TensorSpec((None, FACE_SIZE, FACE_SIZE, 1), tf.float32, name='face'),)
+    _write_atomically(path, lambda tmp_path: tf2onnx.convert.from_keras(
+        model, input_signature=spec, opset=17, output_path=tmp_path))
+    print(f"Exported emotion model to {path}")
+    return path
+
+
+def export_fused_emotion_onnx(path=FUSED_ONNX_PATH, backbone_path=ONNX_PATH):
+    """Prepend face cropping and normalization to the emotion model as ONNX nodes.
+
+    The fused graph takes uint8 grayscale frames (N, 1, H, W), face boxes as
+    (x1, y1, x2, y2) rois and the frame index of every roi.
+    """
+    import onnx
+    from onnx import TensorProto, helper
+
+    if not os.path.exists(backbone_path):
+        export_emotion_onnx(backbone_path)
+    backbone = onnx.load(backbone_path)
+    opset = next(o.version for o in backbone.opset_import if o.domain in ('', 'ai.onnx'))
+
+    nodes = [
+        helper.make_node('Cast', ['frames'], ['frames_f'], to=TensorProto.FLOAT),
+        helper.make_node('Cast', ['roi_batch'], ['roi_batch_i64'], to=TensorProto.INT64),
+        # RoiAlign crops every face and resamples it to 48x48 in one op.
+        helper.make_node('RoiAlign', ['frames_f', 'rois', 'roi_batch_i64'], ['crops'],
+                         output_height=FACE_SIZE, output_width=FACE_SIZE, sampling_ratio=0, mode='avg'),
+        helper.make_node('Mul', ['crops', 'inv_255'], ['crops_norm']),
+        helper.make_node('Transpose', ['crops_norm'], ['faces'], perm=[0, 2, 3, 1]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        'emotion_preprocess',
+        inputs=[
+            helper.make_tensor_value_info('frames', TensorProto.UINT8, ['batch', 1, 'height', 'width']),
+            helper.make_tensor_value_info('rois', TensorProto.FLOAT, ['faces', 4]),
+            helper.make_tensor_value_info('roi_batch', TensorProto.INT32, ['faces']),
+        ],
+        outputs=[helper.make_tensor_value_info('faces', TensorProto.FLOAT, ['faces', FACE_SIZE, FACE_SIZE, 1])],
+        initializer=[helper.make_tensor('inv_255', TensorProto.FLOAT, [], [1.0 / 255.0])],
+    )
+    preprocess = helper.make_model(graph, opset_imports=[helper.make_opsetid('', opset)])
+    preprocess.ir_version = backbone.ir_version
+
+    fused = onnx.compose.merge_models(
+        preprocess, backbone,
+        io_map=[('faces', backbone.graph.input[0].name)],
+        prefix2='emotion/',
+    )
+    onnx.checker.check_model(fused)
+    _write_atomically(path, lambda tmp_path: onnx.save(fused, tmp_path))
+    print(f"Exported fused emotion model to {path}")
+    return path
+
+
+class KerasEmotionEngine:
+    """Calls DeepFace's Keras emotion model directly, skipping DeepFace.analyze."""
+
+    def __init__(self, device='/CPU:0'):
+        self.device = device
+        self.model = load_keras_emotion_model()
+
+    def predict(self, faces):
+        import tensorflow as tf
+
+        with tf.device(self.device):
+            return self.model.predict(faces, verbose=0)
+
+
+def load_calibration_faces(directory=CALIBRATION_DIR, limit=CALIBRATION_FACES):
+    """Crop up to `limit` faces from the images in `directory`, preprocessed like the live path."""
+    if not os.path.isdir(directory):
+        return np.empty((0, FACE_SIZE, FACE_SIZE, 1), dtype=np.float32)
+    crops = []
+    found = 0
+    for name in sorted(os.listdir(directory)):
+        frame = cv2.imread(os.path.join(directory, name))
+        if frame is None:
+            continue
+        gray, _ = to_detection_gray(frame)
+        boxes = detect_faces(gray)
+        if boxes:
+            crops.append(crop_faces(gray, boxes))
+            found += len(boxes)
+            if found >= limit:
+                break
+    if not crops:
+        return np.empty((0, FACE_SIZE, FACE_SIZE, 1), dtype=np.float32)
+    return np.concatenate(crops)[:limit]
+
+
+class _FaceCalibrationReader:
+    """Feeds face crops to ONNX Runtime's calibrator one at a time (a CalibrationDataReader)."""
+
+    def __init__(self, input_name, faces):
+        self._inputs = iter([{input_name: faces[i:i + 1]} for i in range(len(faces))])
+
+    def get_next(self):
+        return next(self._inputs, None)
+
+
+def quantize_emotion_onnx(path=INT8_ONNX_PATH, fp32_path=ONNX_PATH, calibration_dir=CALIBRATION_DIR):
+    """Write a static QDQ INT8 copy of the emotion model, calibrated on real face crops.
+
+    ONNX Runtime turns the QDQ pairs into fused QLinearConv/QLinearMatMul kernels.
+    Dynamic quantization would leave ConvInteger nodes, which only have a slow
+    fallback kernel, so without calibration faces only the dense layers are
+    quantized.
+    """
+    import onnx
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    if not os.path.exists(fp32_path):
+        export_emotion_onnx(fp32_path)
+
+    faces = load_calibration_faces(calibration_dir)
+    if len(faces):
+        input_name = onnx.load(fp32_path).graph.input[0].name
+        _write_atomically(path, lambda tmp_path: quantize_static(
+            fp32_path, tmp_path, _FaceCalibrationReader(input_name, faces),
+            quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8))
+        print(f"Saved INT8 emotion model to {path}, calibrated on {len(faces)} faces")
+    else:
+        print(f"No calibration faces in {calibration_dir}; quantizing only the dense layers.")
+        _write_atomically(path, lambda tmp_path: quantize_dynamic(
+            fp32_path, tmp_path, weight_type=QuantType.QInt8, op_types_to_quantize=['MatMul', 'Gemm']))
+        print(f"Saved INT8 emotion model to {path}")
+    return path
+
+
+class OnnxRuntimeEmotionEngine:
+    """Runs the exported emotion model with ONNX Runtime.
+
+    Uses CUDA when onnxruntime-gpu is installed and falls back to the CPU provider.
+    By default the INT8 model is only used on the CPU, where VNNI-capable
+    processors run its kernels natively; the CUDA provider has no INT8 conv
+    kernels and would hand those nodes back to the CPU.
+    """
+
+    def __init__(self, int8=None):
+        import onnxruntime as ort
+
+        available = ort.get_available_providers()
+        providers = [p for p in ('CUDAExecutionProvider', 'CPUExecutionProvider') if p in available]
+        if int8 is None:
+            int8 = 'CUDAExecutionProvider' not in providers
+
+        path = INT8_ONNX_PATH if int8 else ONNX_PATH
+        if not os.path.exists(path):
+            if int8:
+                quantize_emotion_onnx(path)
+            else:
+                export_emotion_onnx(path)
+
+        self.session = ort.InferenceSession(path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, faces):
+        return self.session.run(None, {self.input_name: faces})[0]
+
+
+class _TensorRTRunner:
+    """Runs an ONNX model as a serialized TensorRT engine.
+
+    The engine is built on first use and cached next to the ONNX file, so later
+    runs only pay for deserialization. The cache name includes `profile_tag`,
+    so changing the optimization profile (e.g. the batch size) builds a new
+    engine instead of loading one that can't take the new shapes. Device
+    buffers grow to the largest input seen and are reused after that.
+    """
+
+    def __init__(self, onnx_path, profile, profile_tag, fp16=True, export=None):
+        import tensorrt as trt
+        import pycuda.driver as cuda
+
+        self.trt = trt
+        self.cuda = cuda
+        self.logger = trt.Logger(trt.Logger.WARNING)
+        # The execution context and staging buffers are shared, so concurrent sessions take turns.
+        self.lock = threading.Lock()
+
+        cuda.init()
+        # The primary context is pushed around every call, so the engine can be used
+        # from whichever thread happens to run the analysis.
+        self.cuda_ctx = cuda.Device(0).retain_primary_context()
+        self.cuda_ctx.push()
+        try:
+            engine_path = f"{os.path.splitext(onnx_path)[0]}_{profile_tag}_{'fp16' if fp16 else 'fp32'}.engine"
+            if os.path.exists(engine_path):
+                with open(engine_path, 'rb') as f:
+                    serialized = f.read()
+            else:
+                if not os.path.exists(onnx_path) and export is not None:
+                    export(onnx_path)
+                serialized = self._build(onnx_path, profile, fp16)
+
+                def write_engine(tmp_path):
+                    with open(tmp_path, 'wb') as f:
+                        f.write(serialized)
+
+                _write_atomically(engine_path, write_engine)
+                print(f"Saved TensorRT engine to {engine_path}")
+
+            self.engine = trt.Runtime(self.logger).deserialize_cuda_engine(serialized)
+            self.context = self.engine.create_execution_context()
+            self.tensor_names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+            self.input_names = [n for n in self.tensor_names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT]
+            self.output_name = next(n for n in self.tensor_names if n not in self.input_names)
+            self.stream = cuda.Stream()
+            self.buffers = {}
+        finally:
+            self.cuda_ctx.pop()
+
+    def _build(self, onnx_path, profile, fp16):
+        trt = self.trt
+        builder = trt.Builder(self.logger)
+        network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, self.logger)
+        with open(onnx_path, 'rb') as f:
+            if not parser.parse(f.read()):
+                errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+                raise RuntimeError(f"Could not parse {onnx_path}: {errors}")
+
+        config = builder.create_builder_config()
+        if fp16 and builder.platform_has_fast_fp16:
+            config.set_flag(trt.BuilderFlag.FP16)
+
+        optimization_profile = builder.create_optimization_profile()
+        for i in range(network.num_inputs):
+            name = network.get_input(i).name
+            # tf2onnx may rename a single input (e.g. 'face:0'), so fall back to the only entry.
+            shapes = profile[name] if name in profile or len(profile) > 1 else next(iter(profile.values()))
+            optimization_profile.set_shape(name, *shapes)
+        config.add_optimization_profile(optimization_profile)
+
+        print("Building TensorRT engine, this only happens once...")
+        serialized = builder.build_serialized_network(network, config)
+        if serialized is None:
+            raise RuntimeError("TensorRT engine build failed.")
+        return bytes(serialized)
+
+    def _buffer(self, name, nbytes):
+        buf = self.buffers.get(name)
+        if buf is None or buf[2] < nbytes:
+            buf = (self.cuda.mem_alloc(nbytes), self.cuda.pagelocked_empty(nbytes, dtype=np.uint8), nbytes)
+            self.buffers[name] = buf
+        return buf
+
+    def run(self, inputs):
+        with self.lock:
+            self.cuda_ctx.push()
+            try:
+                for name, array in inputs.items():
+                    d_buf, h_buf, _ = self._buffer(name, array.nbytes)
+                    np.copyto(h_buf[:array.nbytes].view(array.dtype).reshape(array.shape), array)
+                    if not self.context.set_input_shape(name, array.shape):
+                        raise RuntimeError(f"Input {name} has shape {array.shape}, outside the engine's optimization profile.")
+                    self.cuda.memcpy_htod_async(d_buf, h_buf[:array.nbytes], self.stream)
+
+                shape = tuple(self.context.get_tensor_shape(self.output_name))
+                dtype = np.dtype(self.trt.nptype(self.engine.get_tensor_dtype(self.output_name)))
+                nbytes = int(np.prod(shape)) * dtype.itemsize
+                d_out, h_out, _ = self._buffer(self.output_name, nbytes)
+
+                self.stream.synchronize()
+                if not self.context.execute_v2([int(self.buffers[name][0]) for name in self.tensor_names]):
+                    raise RuntimeError("TensorRT inference failed.")
+                self.cuda.memcpy_dtoh_async(h_out[:nbytes], d_out, self.stream)
+                self.stream.synchronize()
+                return h_out[:nbytes].view(dtype).reshape(shape).copy()
+            finally:
+                self.cuda_ctx.pop()
+
+
+class TensorRTEmotionEngine:
+    """Runs the DeepFace emotion CNN as a TensorRT engine on preprocessed 48x48 crops."""
+
+    def __init__(self, onnx_path=ONNX_PATH, max_batch=16, fp16=True):
+        self.max_batch = max_batch
+        shape = (FACE_SIZE, FACE_SIZE, 1)
+        profile = {'face': ((1, *shape), (max_batch, *shape), (max_batch, *shape))}
+        self.runner = _TensorRTRunner(onnx_path, profile, f"b{max_batch}", fp16, export=export_emotion_onnx)
+
+    def predict(self, faces):
+        name = self.runner.input_names[0]
+        return np.concatenate([self.runner.run({name: faces[start:start + self.max_batch]})
+                               for start in range(0, len(faces), self.max_batch)])
+
+
+class FusedTensorRTEmotionEngine:
+    """Runs the fused crop + normalize + emotion graph as a TensorRT engine.
+
+    Takes raw uint8 grayscale frames and face boxes, so no crops are built in Python.
+    """
+
+    fused = True
+
+    def __init__(self, onnx_path=FUSED_ONNX_PATH, max_batch=16, fp16=True):
+        max_faces = max_batch * MAX_FACES_PER_FRAME
+        typical_height = DETECTION_WIDTH * 3 // 4
+        profile = {
+            'frames': ((1, 1, FACE_SIZE, FACE_SIZE),
+                       (max_batch, 1, typical_height, DETECTION_WIDTH),
+                       (max_batch, 1, MAX_DETECTION_HEIGHT, DETECTION_WIDTH)),
+            'rois': ((1, 4), (max_batch, 4), (max_faces, 4)),
+            'roi_batch': ((1,), (max_batch,), (max_faces,)),
+        }
+        profile_tag = f"b{max_batch}_f{MAX_FACES_PER_FRAME}_h{MAX_DETECTION_HEIGHT}"
+        self.runner = _TensorRTRunner(onnx_path, profile, profile_tag, fp16, export=export_fused_emotion_onnx)
+
+    def infer(self, frames, rois, roi_batch):
+        return self.runner.run({'frames': frames, 'rois': rois, 'roi_batch': roi_batch})
+
+    def predict(self, faces):
+        # Already-cropped faces (e.g. the warmup input) are fed as tiny frames covering one face each.
+        n = len(faces)
+        frames = np.ascontiguousarray((faces[..., 0] * 255).astype(np.uint8)[:, None])
+        rois = np.tile(np.array([0, 0, FACE_SIZE, FACE_SIZE], dtype=np.float32), (n, 1))
+        return self.infer(frames, rois, np.arange(n, dtype=np.int32))
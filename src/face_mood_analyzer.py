@@ -1,108 +1,246 @@
+import os
+
+# GPU inference needs a CUDA-enabled TensorFlow build (`pip install tensorflow-gpu`,
+# or `tensorflow[and-cuda]` on TF >= 2.15). These must be set before TF is imported.
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+os.environ.setdefault("TF_FORCE_GPU_ALLOW_GROWTH", "true")
+
 import cv2
-from deepface import DeepFace
+import numpy as np
+import tensorflow as tf
 import time
-from collections import Counter
+from collections import Counter, deque
+from dataclasses import dataclass, field
 import threading
+from . import emotion_engine
 
-data_lock = threading.Lock()
-latest_frame = None
-latest_analysis = {}
-last_known_emotions = []
-stop_thread = False
+try:
+    BATCH_SIZE = max(1, int(os.getenv("MOOD_BATCH_SIZE", "16")))
+except ValueError:
+    BATCH_SIZE = 16
 
-def analyze_face_emotions():
-    global latest_frame, latest_analysis, last_known_emotions, data_lock, stop_thread
-    
-    print("Background analysis thread started.")
+# 'keras' calls DeepFace's emotion model directly; 'tensorrt' runs it as a TensorRT
+# engine (needs tensorrt, pycuda and tf2onnx on an NVIDIA GPU); 'tensorrt-fused' also
+# moves face cropping and normalization into the engine (additionally needs onnx);
+# 'onnxruntime' runs it with ONNX Runtime: an INT8-quantized copy on CPU, FP32 on GPU.
+EMOTION_BACKEND = os.getenv("MOOD_EMOTION_BACKEND", "keras").strip().lower()
+
+GPUS = tf.config.list_physical_devices('GPU')
+for gpu in GPUS:
+    try:
+        tf.config.experimental.set_memory_growth(gpu, True)
+    except RuntimeError:
+        pass
+INFERENCE_DEVICE = '/GPU:0' if GPUS else '/CPU:0'
+
+def _load_emotion_model():
+    if EMOTION_BACKEND == 'tensorrt':
+        return emotion_engine.TensorRTEmotionEngine(max_batch=BATCH_SIZE)
+    if EMOTION_BACKEND == 'tensorrt-fused':
+        return emotion_engine.FusedTensorRTEmotionEngine(max_batch=BATCH_SIZE)
+    if EMOTION_BACKEND == 'onnxruntime':
+        return emotion_engine.OnnxRuntimeEmotionEngine()
+    return emotion_engine.KerasEmotionEngine(device=INFERENCE_DEVICE)
+
+# Loaded once at import; DeepFace.analyze would look the model and detector up on every call.
+emotion_model = _load_emotion_model()
+
+# Capture stops early once one non-neutral emotion holds a clear majority.
+MIN_CAPTURE_SECONDS = 3
+MAX_CAPTURE_SECONDS = 30
+STABLE_MIN_SAMPLES = 10
+STABLE_RATIO = 0.6
+
+warmed_up = False
+
+
+@dataclass
+class MoodAnalyzerSession:
+    """State shared by one capture loop and its analysis thread.
+
+    Each field has a single writer. The capture loop appends to frames and the
+    analysis thread pops from them, which deque does atomically. analysis and
+    non_neutral_lead are written only by the analysis thread, by replacing the
+    object, so the capture loop reads them without a lock. The counters are
+    updated in place and are only read once the analysis thread has been joined.
+    """
+    frames: deque = field(default_factory=lambda: deque(maxlen=BATCH_SIZE))
+    analysis: dict = field(default_factory=dict)
+    counts: Counter = field(default_factory=Counter)
+    non_neutral_counts: Counter = field(default_factory=Counter)
+    # (non-neutral samples, samples of the leading non-neutral emotion)
+    non_neutral_lead: tuple = (0, 0)
+    stop_evt: threading.Event = field(default_factory=threading.Event)
+
+
+def _warmup():
+    # The first forward pass pays for cuDNN initialisation and graph tracing;
+    # do it once on a dummy face so the first real batch isn't delayed.
+    global warmed_up
+    if warmed_up:
+        return
+    try:
+        emotion_model.predict(np.zeros((1, emotion_engine.FACE_SIZE, emotion_engine.FACE_SIZE, 1), dtype=np.float32))
+        warmed_up = True
+    except Exception as e:
+        print(f"Warmup failed: {e}")
+
+def analyze_face_emotions(session):
+    _warmup()
+    print(f"Background analysis thread started ({EMOTION_BACKEND} backend, batch size {BATCH_SIZE}).")
     
-    while not stop_thread:
-        with data_lock:
-            if latest_frame is None:
-                time.sleep(0.1) 
-                continue
-            frame_to_analyze = latest_frame.copy()
+    while not session.stop_evt.is_set():
+        batch = []
+        while len(batch) < BATCH_SIZE and not session.stop_evt.is_set():
+            try:
+                batch.append(session.frames.popleft())
+            except IndexError:
+                session.stop_evt.wait(0.005)
+        if len(batch) < BATCH_SIZE:
+            continue
 
         try:
-            analysis_list = DeepFace.analyze(
-                frame_to_analyze, 
-                actions=['emotion'], 
-                enforce_detection=False, 
-                detector_backend='opencv',
-                silent=True
-            )
-            
-            if analysis_list and isinstance(analysis_list, list) and analysis_list[0]:
-                analysis = analysis_list[0]
-                
-                with data_lock:
-                    latest_analysis = analysis 
-                    last_known_emotions.append(analysis['dominant_emotion'])
+            # Faces from every frame in the batch go through the model in one forward pass.
+            results = emotion_engine.analyze_frames(emotion_model, batch)
+
+            for analysis_list in results:
+                if analysis_list and isinstance(analysis_list, list) and analysis_list[0]:
+                    analysis = analysis_list[0]
+                    # Swapping the reference is atomic, so the display loop can read it without a copy.
+                    session.analysis = analysis
+                    dom = analysis['dominant_emotion']
+                    session.counts[dom] += 1
+                    if dom != 'neutral':
+                        session.non_neutral_counts[dom] += 1
+                        # Published as one tuple so the capture loop never iterates a Counter
+                        # this thread is still updating.
+                        total, _ = session.non_neutral_lead
+                        session.non_neutral_lead = (total + 1, session.non_neutral_counts.most_common(1)[0][1])
+
+            # No face in the newest frame: clear the overlay rather than leave the last box frozen.
+            if results and not results[-1]:
+                session.analysis = {}
 
         except Exception as e:
-            with data_lock:
-                latest_analysis = {}
-        
-        time.sleep(0.5) 
+            print(f"Emotion analysis failed: {e}")
+            session.analysis = {}
     
     print("Background analysis thread stopped.")
 
 
-def get_mood_from_webcam():
-    global latest_frame, latest_analysis, last_known_emotions, data_lock, stop_thread
-    
-    latest_frame = None
-    latest_analysis = {}
-    last_known_emotions = []
-    stop_thread = False
+def _render_text(text, scale, color, thickness):
+    (text_w, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    patch = np.zeros((text_h + baseline + thickness, text_w + thickness, 3), dtype=np.uint8)
+    cv2.putText(patch, text, (0, text_h), cv2.FONT_HERSHEY_SIMPLEX, scale, color, thickness)
+    return patch, text_h
+
+
+EMOTIONS_LABEL, EMOTIONS_LABEL_H = _render_text("---EMOTIONS---", 0.6, (255, 255, 0), 2)
+OVERLAY_TOP = 10  # gap between the face box and the text block
+LABEL_BASELINE = 20
+LINE_START = LABEL_BASELINE + 25
+LINE_HEIGHT = 20
+
+
+def _build_overlay(analysis):
+    # Rasterize the emotion text once per analysis result; every frame in between
+    # just pastes the finished patch instead of re-running putText per glyph.
+    facial_area = analysis['region']
+    box = (facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h'])
+    emotions = analysis.get('emotion', {})
+    dominant_emotion = analysis.get('dominant_emotion', 'N/A')
+
+    lines = [(f"{emotion.capitalize()}: {score:.1f}%", (0, 255, 0) if emotion == dominant_emotion else (255, 255, 255))
+             for emotion, score in emotions.items()]
+    width = max([EMOTIONS_LABEL.shape[1]] + [cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)[0][0] for text, _ in lines])
+    height = max(LABEL_BASELINE - EMOTIONS_LABEL_H + EMOTIONS_LABEL.shape[0], LINE_START + LINE_HEIGHT * len(lines))
+    patch = np.zeros((height, width + 1, 3), dtype=np.uint8)
+
+    label_top = LABEL_BASELINE - EMOTIONS_LABEL_H
+    label_h, label_w = EMOTIONS_LABEL.shape[:2]
+    np.copyto(patch[label_top:label_top + label_h, :label_w], EMOTIONS_LABEL)
+
+    y_text_offset = LINE_START
+    for text, color in lines:
+        cv2.putText(patch, text, (0, y_text_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        y_text_offset += LINE_HEIGHT
+    return box, patch
+
+
+def _blit(frame, patch, x, y):
+    frame_h, frame_w = frame.shape[:2]
+    patch_h, patch_w = patch.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + patch_w, frame_w), min(y + patch_h, frame_h)
+    if x0 >= x1 or y0 >= y1:
+        return
+    src = patch[y0 - y:y1 - y, x0 - x:x1 - x]
+    # Only the drawn pixels are copied, so the text stays transparent like putText.
+    np.copyto(frame[y0:y1, x0:x1], src, where=src.any(axis=2, keepdims=True))
+
+
+def _mood_is_stable(session):
+    total, leading = session.non_neutral_lead
+    return total >= STABLE_MIN_SAMPLES and leading / total > STABLE_RATIO
+
+
+def get_mood_from_webcam(source=0):
+    session = MoodAnalyzerSession()
     
-    cap = cv2.VideoCapture(0)
+    cap = cv2.VideoCapture(source)
     if not cap.isOpened():
         print("Error: Could not open webcam.")
         return None
 
+    # Keep only the newest frame in the driver queue so reads aren't ~4 frames stale,
+    # and capture at 640x480: the emotion model only ever sees 48x48 face crops.
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+
     window_name = 'Mood Analyzer - Look at the camera!'
     cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
     cv2.resizeWindow(window_name, 800, 600)
 
     print("Analyzing your mood... The camera window will pop up.")
-    print("Capturing mood for 30 seconds... Press 'q' to stop early.")
+    print(f"Capturing mood for up to {MAX_CAPTURE_SECONDS} seconds... Press 'q' to stop early.")
 
-    analysis_thread = threading.Thread(target=analyze_face_emotions, daemon=True)
+    analysis_thread = threading.Thread(target=analyze_face_emotions, args=(session,), daemon=True)
     analysis_thread.start()
 
     start_time = time.time()
+    drawn_analysis = None
+    overlay = None
     
-    while (time.time() - start_time) < 30:
+    while (time.time() - start_time) < MAX_CAPTURE_SECONDS:
         ret, frame = cap.read()
         if not ret:
             break
+
+        if time.time() - start_time >= MIN_CAPTURE_SECONDS and _mood_is_stable(session):
+            print("Mood is stable, stopping early.")
+            break
         
+        # read() hands out a fresh array every call and flip() writes a new one, so the
+        # analyzer can keep the raw frame while we draw on the mirrored copy. The bounded
+        # deque drops the oldest frame when analysis falls behind.
+        session.frames.append(frame)
+        frame_w = frame.shape[1]
         frame = cv2.flip(frame, 1)
 
-        with data_lock:
-            latest_frame = frame.copy()
-            current_analysis = latest_analysis.copy()
-
-        if current_analysis:
+        current_analysis = session.analysis
+        if current_analysis is not drawn_analysis:
+            drawn_analysis = current_analysis
             try:
-                facial_area = current_analysis['region']
-                x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                
-                emotions = current_analysis.get('emotion', {})
-                dominant_emotion = current_analysis.get('dominant_emotion', 'N/A')
-                
-                y_text_offset = y + h + 30
-                cv2.putText(frame, "---EMOTIONS---", (x, y_text_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 2)
-                y_text_offset += 25
-
-                for emotion, score in emotions.items():
-                    text = f"{emotion.capitalize()}: {score:.1f}%"
-                    color = (0, 255, 0) if emotion == dominant_emotion else (255, 255, 255)
-                    cv2.putText(frame, text, (x, y_text_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
-                    y_text_offset += 20
+                overlay = _build_overlay(current_analysis) if current_analysis else None
             except Exception:
-                pass 
+                overlay = None
+
+        if overlay:
+            (x, y, w, h), patch = overlay
+            x = frame_w - x - w
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            _blit(frame, patch, x, y + h + OVERLAY_TOP)
         
         cv2.imshow(window_name, frame)
         
@@ -111,25 +249,21 @@ def get_mood_from_webcam():
             break
 
     print("Stopping analysis thread...")
-    stop_thread = True 
+    session.stop_evt.set()
     cap.release()
     cv2.destroyAllWindows()
-    analysis_thread.join(timeout=2) 
+    # No timeout: the thread exits after its current batch, and the counters below
+    # must not be read while it can still add to them.
+    analysis_thread.join()
     print("Mood analysis complete.")
 
-    if not last_known_emotions:
+    if not session.counts:
         print("Could not detect any mood. Defaulting to neutral.")
         return 'neutral'
     
-    emotional_moods = [mood for mood in last_known_emotions if mood != 'neutral']
+    # Prefer any non-neutral emotion; fall back to neutral only if nothing else was seen.
+    final_mood = (session.non_neutral_counts or session.counts).most_common(1)[0][0]
     
-    if emotional_moods:
-        mood_counts = Counter(emotional_moods)
-        final_mood = mood_counts.most_common(1)[0][0]
-    else:
-        mood_counts = Counter(last_known_emotions)
-        final_mood = mood_counts.most_common(1)[0][0]
-        
     print(f"Final determined mood: {final_mood.capitalize()}")
     return final_mood
 
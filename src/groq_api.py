@@ -2,9 +2,13 @@ import os
 import re
 import time
 import json
+import random
 import logging
-from dataclasses import dataclass
-from typing import List, Optional
+import threading
+import functools
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+import httpx
 from dotenv import load_dotenv
 from groq import Groq
 
@@ -13,6 +17,14 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("groq_artists")
 
+_FENCE_RE = re.compile(r"^```[a-zA-Z0-9]*\s*|\s*```$", re.MULTILINE)
+_BULLET_RE = re.compile(r"^\s*(?:[\-\*\u2022•]|[0-9]{1,2}[.)])\s*")
+_QUOTE_RE = re.compile(r"^[\"'“”‘’]+|[\"'“”‘’]+$")
+_LETTER_RE = re.compile(r"[A-Za-z\u00C0-\u024F\u0400-\u04FF\u3040-\u30FF\u4E00-\u9FFF\uAC00-\uD7AF]")
+_BAD_PREFIXES = ("artists:", "here are", "list:", "output", "names:")
+# Single-line responses are split on the first of these that appears, in priority order.
+_SEPARATORS = (" | ", " • ", ",")
+
 @dataclass(frozen=True)
 class GroqArtistConfig:
     api_key: str
@@ -25,59 +37,73 @@ class GroqArtistConfig:
     enforce_count: int = 10
 
 class GroqMusicArtistService:
-    def __init__(self, config: GroqArtistConfig):
+    def __init__(self, config: GroqArtistConfig, http_client: Optional[httpx.Client] = None):
         self.config = config
-        self.client = Groq(api_key=config.api_key)
+        self.client = Groq(api_key=config.api_key, http_client=http_client)
+        # Private RNG so retry jitter doesn't touch (or depend on) the global random state.
+        self._rng = random.Random()
 
-    def get_artists(self, mood: str, language: Optional[str] = None, count: Optional[int] = None) -> List[str]:
+    def _normalize(self, mood: str, language: Optional[str], count: Optional[int]) -> Optional[Tuple[str, Optional[str], int]]:
         if not isinstance(mood, str) or not mood.strip():
-            return []
+            return None
         mood = mood.strip()
         if language is not None and (not isinstance(language, str) or not language.strip()):
             language = None
-        target_count = count or self.config.enforce_count
-        attempts = max(1, self.config.retries)
-        system_base = (
+        return mood, language, count or self.config.enforce_count
+
+    def _build_messages(self, mood: str, language: Optional[str], target_count: int, attempt: int) -> List[dict]:
+        system_prompt = (
             f"You are a music expert. Output exactly {target_count} distinct, well-known, popular recording artists who match the user's mood and optional language. "
             "Artists must be primary performers (solo singers, bands, DJs). Use official spellings as on Spotify. "
             "Output format: one artist name per line, no numbers, no bullets, no punctuation, no explanations, no extra text. "
             "Exclude actors or non-performing composers. If a language is provided, primarily choose artists who release music in that language."
         )
+        if attempt == 2:
+            system_prompt += " Return ONLY the names. Do not include any headings or counts."
+        if attempt >= 3:
+            system_prompt += f" Return EXACTLY {target_count} lines with ONLY the artist name on each line."
 
-        for attempt in range(1, attempts + 1):
-            system_prompt = system_base
-            if attempt == 2:
-                system_prompt += " Return ONLY the names. Do not include any headings or counts."
-            if attempt >= 3:
-                system_prompt += f" Return EXACTLY {target_count} lines with ONLY the artist name on each line."
+        user_parts = [f"Mood: {mood}"]
+        if language:
+            user_parts.append(f"Language: {language}")
+        user_prompt = " | ".join(user_parts)
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
 
-            user_parts = [f"Mood: {mood}"]
-            if language:
-                user_parts.append(f"Language: {language}")
-            user_prompt = " | ".join(user_parts)
+    def _next_backoff(self, prev_delay: float) -> float:
+        # Decorrelated jitter: concurrent callers that fail together don't retry in lockstep.
+        return min(self.config.backoff_max, self._rng.uniform(self.config.backoff_initial, prev_delay * 3))
 
+    def get_artists(self, mood: str, language: Optional[str] = None, count: Optional[int] = None) -> List[str]:
+        params = self._normalize(mood, language, count)
+        if params is None:
+            return []
+        mood, language, target_count = params
+        attempts = max(1, self.config.retries)
+        delay = self.config.backoff_initial
+
+        for attempt in range(1, attempts + 1):
             try:
                 logger.info(f"Requesting artists (attempt {attempt}/{attempts})")
                 completion = self.client.chat.completions.create(
                     model=self.config.model,
                     temperature=self.config.temperature,
                     max_tokens=self.config.max_tokens,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ],
+                    messages=self._build_messages(mood, language, target_count, attempt),
                 )
                 raw = completion.choices[0].message.content if completion and completion.choices else ""
                 artists = self._parse_artists(raw, target_count)
                 if len(artists) == target_count:
                     return artists
                 if attempt < attempts:
-                    delay = min(self.config.backoff_initial * (2 ** (attempt - 1)), self.config.backoff_max)
+                    delay = self._next_backoff(delay)
                     time.sleep(delay)
             except Exception as e:
                 logger.warning(f"Groq request failed on attempt {attempt}/{attempts}: {e}")
                 if attempt < attempts:
-                    delay = min(self.config.backoff_initial * (2 ** (attempt - 1)), self.config.backoff_max)
+                    delay = self._next_backoff(delay)
                     time.sleep(delay)
                 else:
                     return []
@@ -87,24 +113,23 @@ class GroqMusicArtistService:
         if not raw or not isinstance(raw, str):
             return []
         text = raw.strip()
-        text = re.sub(r"^```[a-zA-Z0-9]*\s*|\s*```$", "", text, flags=re.MULTILINE)
-        lines = [l for l in text.replace("\r", "").split("\n") if l.strip()]
-        if len(lines) == 1 and ("," in lines[0] or " • " in lines[0] or " | " in lines[0]):
-            sep = ","
-            if " • " in lines[0]:
-                sep = " • "
-            if " | " in lines[0]:
-                sep = " | "
-            lines = [p for p in [x.strip() for x in lines[0].split(sep)] if p]
+        text = _FENCE_RE.sub("", text)
+        lines = [l for l in text.splitlines() if l.strip()]
+        if len(lines) == 1:
+            for sep in _SEPARATORS:
+                if sep in lines[0]:
+                    lines = [p for p in (x.strip() for x in lines[0].split(sep)) if p]
+                    break
 
         cleaned = []
         seen = set()
         for line in lines:
-            item = re.sub(r"^\s*(?:[\-\*\u2022•]|[0-9]{1,2}[.)])\s*", "", line).strip()
-            item = re.sub(r"^[\"'“”‘’]+|[\"'“”‘’]+$", "", item).strip()
-            if any(prefix in item.lower() for prefix in ["artists:", "here are", "list:", "output", "names:"]):
+            item = _BULLET_RE.sub("", line).strip()
+            item = _QUOTE_RE.sub("", item).strip()
+            lowered = item.lower()
+            if any(prefix in lowered for prefix in _BAD_PREFIXES):
                 continue
-            if not re.search(r"[A-Za-z\u00C0-\u024F\u0400-\u04FF\u3040-\u30FF\u4E00-\u9FFF\uAC00-\uD7AF]", item):
+            if not _LETTER_RE.search(item):
                 continue
             key = item.casefold()
             if key in seen:
@@ -144,12 +169,71 @@ def _load_config() -> Optional[GroqArtistConfig]:
         retries=retries,
     )
 
+try:
+    _CACHE_SIZE = int(os.getenv("GROQ_CACHE_SIZE", "256"))
+except ValueError:
+    _CACHE_SIZE = 256
+
+_SERVICE: Optional[GroqMusicArtistService] = None
+_service_lock = threading.Lock()
+
+def _get_service() -> Optional[GroqMusicArtistService]:
+    # One long-lived service (and connection pool) per process, so repeat calls
+    # reuse the open TLS connection instead of handshaking again.
+    global _SERVICE
+    if _SERVICE is not None:
+        return _SERVICE
+    with _service_lock:
+        if _SERVICE is None:
+            cfg = _load_config()
+            if not cfg:
+                return None
+            limits = httpx.Limits(max_keepalive_connections=10)
+            try:
+                http_client = httpx.Client(http2=True, limits=limits)
+            except ImportError:
+                # httpx only speaks HTTP/2 with the optional h2 package; keep-alive still saves the handshakes.
+                logger.warning("h2 is not installed, using HTTP/1.1 for Groq (pip install 'httpx[http2]')")
+                http_client = httpx.Client(limits=limits)
+            _SERVICE = GroqMusicArtistService(cfg, http_client=http_client)
+    return _SERVICE
+
+@dataclass(frozen=True)
+class _ArtistQuery:
+    # Hashed and compared on the normalized key only; the original strings ride along
+    # so the prompt keeps the caller's spelling.
+    mood_key: str
+    language_key: Optional[str]
+    count: int
+    mood: str = field(compare=False)
+    language: Optional[str] = field(compare=False)
+
+class _NoArtists(Exception):
+    """Raised inside the cached lookup so failed requests are not memoized."""
+
+# Responses are deterministic enough (low temperature) and the (mood, language) space is
+# tiny, so repeat lookups are served from memory instead of another Groq round trip.
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _get_artists_cached(query: _ArtistQuery) -> Tuple[str, ...]:
+    service = _get_service()
+    if not service:
+        raise _NoArtists()
+    artists = service.get_artists(mood=query.mood, language=query.language, count=query.count)
+    # Empty results are failures (bad key, network, unparseable output) and must not stick.
+    if not artists:
+        raise _NoArtists()
+    # A tuple, so callers can't mutate the cached entry.
+    return tuple(artists)
+
 def get_artists_from_groq(mood: str, language: Optional[str] = None) -> List[str]:
-    cfg = _load_config()
-    if not cfg:
+    if not isinstance(mood, str) or not mood.strip():
+        return []
+    language_key = language.strip().casefold() if isinstance(language, str) and language.strip() else None
+    query = _ArtistQuery(mood.strip().casefold(), language_key, 10, mood, language)
+    try:
+        return list(_get_artists_cached(query))
+    except _NoArtists:
         return []
-    service = GroqMusicArtistService(cfg)
-    return service.get_artists(mood=mood, language=language, count=10)
 
 if __name__ == "__main__":
     import argparse
@@ -1,4 +1,4 @@
-from src.app import app
+from src.app import serve
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    serve()
\ No newline at end of file
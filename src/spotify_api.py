@@ -1,4 +1,5 @@
 import os
+import threading
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
@@ -14,16 +15,40 @@ def _get_spotify_client():
             scope='playlist-modify-private'
         )
         sp = spotipy.Spotify(auth_manager=sp_oauth)
-        user_id = sp.current_user()['id']
-        print(f"Authenticated as: {sp.current_user()['display_name']}")
-        return sp, user_id
+        user = sp.current_user()
+        print(f"Authenticated as: {user['display_name']}")
+        return sp, user['id']
     except Exception as e:
         print(f"Error during Spotify authentication: {e}")
         print("Please check your SPOTIPY environment variables and redirect URI setup.")
         return None, None
 
+_client = None
+_client_lock = threading.Lock()
+
+def ensure_authed():
+    """Return a ready (client, user_id) pair, refreshing the token if needed.
+
+    The client is created once and reused, so callers can run this ahead of time
+    (e.g. while the webcam is capturing) and the playlist calls find it warm.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            sp, user_id = _client
+            try:
+                sp.auth_manager.get_access_token(as_dict=False)
+                return sp, user_id
+            except Exception as e:
+                print(f"Spotify token refresh failed, re-authenticating: {e}")
+                _client = None
+        sp, user_id = _get_spotify_client()
+        if sp:
+            _client = (sp, user_id)
+        return sp, user_id
+
 def create_playlist_from_artists(artists, mood, playlist_name):
-    sp, user_id = _get_spotify_client()
+    sp, user_id = ensure_authed()
     if not sp:
         return None, None
     
@@ -71,7 +96,7 @@ def create_playlist_from_artists(artists, mood, playlist_name):
 
 
 def create_playlist_for_one_artist(artist_name, playlist_name):
-    sp, user_id = _get_spotify_client()
+    sp, user_id = ensure_authed()
     if not sp:
         return None, None
 